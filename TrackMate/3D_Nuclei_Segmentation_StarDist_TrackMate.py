@@ -4,48 +4,714 @@
 #@ Double (label="Overlap threshold", value=0.3, min=0, max=1, stepSize=0.1) overlap_threshold
 #@ Double (label="Min IOU for z-connection", value=0.1, min=0, max=1, stepSize=0.05) min_iou
 #@ Boolean (label="Append labels to original image", value=true) append_to_original
+#@ Integer (label="Tile size for large images (0 = no tiling)", value=0, min=0) tile_size
+#@ Boolean (label="Segment all timepoints in one TrackMate run", value=false) single_run
 #@ File (label="Output directory", style="directory") output_dir
 
 # Script to create semi-3D stardist segmentation from 3D-timeseries using TrackMate
 # As explained here: https://imagej.net/plugins/trackmate/detectors/trackmate-stardist
 # Developed by Maarten Paul (m.w.paul@lacdr.leidenuniv.nl) @maartenpaul at Github
+# To process many files in parallel, run Batch_3D_Nuclei_Segmentation_parallel.py,
+# which starts one headless Fiji process per file with this script
 
 # Version 2025-11-21: Initial version of the script
+# Version 2026-10-15: Labels are streamed to a BigTIFF OME-TIFF per timepoint instead of
+#                     building the full label hyperstack in memory
 
 import sys
 import os
+from threading import Lock
 from ij import IJ, ImagePlus, ImageStack
-from ij.plugin import Duplicator, HyperStackConverter, RGBStackMerge
-from fiji.plugin.trackmate import Model, Settings, TrackMate, Logger
+from ij.measure import Measurements
+from ij.process import Blitter, ImageProcessor, ImageStatistics, ShortProcessor
+from fiji.plugin.trackmate import Model, Settings, Spot, TrackMate, Logger
 from fiji.plugin.trackmate.stardist import StarDistDetectorFactory
 from fiji.plugin.trackmate.tracking.overlap import OverlapTrackerFactory
 from fiji.plugin.trackmate.action.LabelImgExporter import LabelIdPainting
 import fiji.plugin.trackmate.action.LabelImgExporter as LabelImgExporter
 from java.io import File
+from java.lang import Runnable, System, Thread
+from java.util.concurrent import ArrayBlockingQueue
+from jarray import zeros
+from loci.common import DataTools, NIOFileHandle
+from loci.formats import FormatTools, MetadataTools
+from loci.formats.out import OMETiffWriter, TiffWriter
+from loci.plugins import BF
+from loci.plugins.in import ImporterOptions
 
 # Set UTF-8 encoding
 reload(sys)
 sys.setdefaultencoding('utf-8')
 
-print("=" * 60)
-print("3D NUCLEI SEGMENTATION WITH STARDIST")
-print("=" * 60)
-print("Number of files to process: {}".format(len(input_files)))
-print("Append to original: {}".format(append_to_original))
-print("=" * 60)
+# Smaller read buffer for Bio-Formats file handles (default 1 MB), avoids allocating
+# a large buffer for every small read
+NIOFileHandle.setDefaultBufferSize(16384)
+
+# Virtual stacks share one Bio-Formats reader, which must not be used by the
+# reader and writer threads at the same time
+plane_lock = Lock()
+
+# Log messages are collected and written to the console in one go per timepoint
+# and per file, instead of flushing the console for every line
+log_buffer = []
+log_lock = Lock()
+
+# Marks the end of the timepoints in the pipeline queues
+END_OF_STREAM = object()
+
+# Overlap in pixels between neighbouring tiles, and the IoU in the overlap above
+# which labels of neighbouring tiles are merged into one nucleus
+TILE_OVERLAP = 32
+TILE_MIN_IOU = 0.5
+
+
+def log(message):
+    """Add a message to the log buffer (thread safe)"""
+    with log_lock:
+        log_buffer.append(message)
+
+
+def flush_log():
+    """Write all buffered log messages to the console"""
+    with log_lock:
+        if log_buffer:
+            sys.stdout.write("\n".join(log_buffer) + "\n")
+            del log_buffer[:]
+    sys.stdout.flush()
+
+
+class PipelineStage(Runnable):
+    """Runs a function in its own java.lang.Thread"""
+    def __init__(self, target):
+        self.target = target
+    
+    def run(self):
+        self.target()
+
+
+def open_image(path):
+    """Open an image with Bio-Formats as a virtual stack, so planes are only read
+    from disk when they are used. For nd2 files Bio-Formats reads the chunk map
+    instead of scanning the whole file."""
+    options = ImporterOptions()
+    options.setId(path)
+    options.setVirtual(True)
+    options.setOpenAllSeries(False)
+    options.setQuiet(True)
+    options.setWindowless(True)
+    try:
+        return BF.openImagePlus(options)[0]
+    except Exception as e:
+        log("Bio-Formats could not open the file ({}), trying ImageJ".format(str(e)))
+        return IJ.openImage(path)
+
+
+def fits_in_memory(n_bytes):
+    """Check if n_bytes can be allocated while leaving the same amount free for TrackMate"""
+    return 2 * n_bytes < IJ.maxMemory() - IJ.currentMemory()
+
+
+def open_writer(path, imp, n_channels_out, pixel_type):
+    """Open a BigTIFF OME-TIFF writer for an XYCZT stack with the size and
+    calibration of imp and n_channels_out channels. Planes are written one by
+    one with saveBytes, so the output never has to fit in memory."""
+    output_file = File(path)
+    if output_file.exists():
+        # The writer would append to an existing file
+        output_file.delete()
+    
+    meta = MetadataTools.createOMEXMLMetadata()
+    MetadataTools.populateMetadata(meta, 0, output_file.getName(), True, "XYCZT", pixel_type,
+                                   imp.getWidth(), imp.getHeight(), imp.getNSlices(),
+                                   n_channels_out, imp.getNFrames(), 1)
+    cal = imp.getCalibration()
+    if cal.scaled():
+        unit = cal.getUnit()
+        meta.setPixelsPhysicalSizeX(FormatTools.getPhysicalSizeX(cal.pixelWidth, unit), 0)
+        meta.setPixelsPhysicalSizeY(FormatTools.getPhysicalSizeY(cal.pixelHeight, unit), 0)
+        meta.setPixelsPhysicalSizeZ(FormatTools.getPhysicalSizeZ(cal.pixelDepth, unit), 0)
+    if cal.frameInterval > 0:
+        time_increment = FormatTools.getTime(cal.frameInterval, cal.getTimeUnit())
+        if time_increment is not None:
+            meta.setPixelsTimeIncrement(time_increment, 0)
+    
+    writer = OMETiffWriter()
+    writer.setMetadataRetrieve(meta)
+    writer.setBigTiff(True)
+    # Lossless; label planes consist of long runs of equal values and compress well
+    writer.setCompression(TiffWriter.COMPRESSION_LZW)
+    writer.setWriteSequentially(True)
+    writer.setId(path)
+    return writer
+
+
+def plane_bytes(ip, pixel_type):
+    """Pixels of ip as little-endian bytes of the output pixel type"""
+    if pixel_type == "float":
+        return DataTools.floatsToBytes(ip.convertToFloatProcessor().getPixels(), True)
+    if not isinstance(ip, ShortProcessor):
+        ip = ip.convertToShortProcessor(False)
+    return DataTools.shortsToBytes(ip.getPixels(), True)
+
+
+def renumber_labels(ips):
+    """Renumber the labels in the planes of one timepoint to 1..n, in order of
+    their IDs. Returns the renumbered planes as 16-bit processors."""
+    lowest = 1
+    if ips[0].getBitDepth() == 32:
+        # IDs of a float label image may exceed 65535, shift them down to the
+        # lowest ID of this timepoint before converting the planes to 16-bit
+        lowest = highest = None
+        for ip in ips:
+            ip.setThreshold(1, 1e30, ImageProcessor.NO_LUT_UPDATE)
+            stats = ImageStatistics.getStatistics(ip, Measurements.MIN_MAX | Measurements.LIMIT, None)
+            ip.resetThreshold()
+            if stats.pixelCount > 0:
+                lowest = stats.min if lowest is None else min(lowest, stats.min)
+                highest = stats.max if highest is None else max(highest, stats.max)
+        if lowest is None:
+            lowest = 1
+        elif highest - lowest >= 65535:
+            log("  WARNING: More than 65535 label IDs in a timepoint, some nuclei share the last label ID")
+        lowest = int(lowest)
+    
+    planes = []
+    for ip in ips:
+        if lowest > 1:
+            ip = ip.duplicate()
+            ip.subtract(lowest - 1)
+            ip.min(0)
+        planes.append(ip.convertToShortProcessor(False))
+    
+    # Histogram of all planes at once, from one tall image
+    plane_size = planes[0].getPixelCount()
+    merged = ShortProcessor(planes[0].getWidth(), planes[0].getHeight() * len(planes))
+    merged_pixels = merged.getPixels()
+    for i, ip in enumerate(planes):
+        System.arraycopy(ip.getPixels(), 0, merged_pixels, i * plane_size, plane_size)
+    histogram = merged.getHistogram()
+    
+    lut = zeros(65536, 'i')
+    n = 0
+    for label in range(1, int(merged.getStats().max) + 1):
+        if histogram[label]:
+            n += 1
+            lut[label] = n
+    for ip in planes:
+        ip.applyTable(lut)
+    return planes
+
+
+def unlink_blocks(model, frames_per_block):
+    """Remove all links between spots in different blocks of frames_per_block
+    frames, so no track spans more than one block"""
+    def block(spot):
+        return int(spot.getFeature(Spot.FRAME)) // frames_per_block
+    
+    track_model = model.getTrackModel()
+    edges = [edge for edge in track_model.edgeSet()
+             if block(track_model.getEdgeSource(edge)) != block(track_model.getEdgeTarget(edge))]
+    if not edges:
+        return
+    model.beginUpdate()
+    try:
+        for edge in edges:
+            model.removeEdge(edge)
+    finally:
+        model.endUpdate()
+
+
+def run_trackmate(imp_frames, frames_per_block=0):
+    """Run StarDist + overlap tracking on z-slices stored as frames. With
+    frames_per_block, tracks are cut at every block of that many frames.
+    Returns the label image, or None if TrackMate failed."""
+    # Set up TrackMate
+    model = Model()
+    model.setLogger(Logger.IJ_LOGGER)
+    
+    settings = Settings(imp_frames)
+    
+    # Only the input image changes between timepoints
+    settings.detectorFactory = detector_factory
+    settings.detectorSettings = dict(detector_settings)
+    settings.trackerFactory = tracker_factory
+    settings.trackerSettings = dict(tracker_settings)
+    
+    # No feature analyzers: only the track IDs are exported to the label image
+    
+    # Run TrackMate
+    trackmate = TrackMate(model, settings)
+    
+    if not trackmate.checkInput():
+        log("  ERROR: {}".format(trackmate.getErrorMessage()))
+        return None
+    
+    if not trackmate.process():
+        log("  ERROR: {}".format(trackmate.getErrorMessage()))
+        return None
+    
+    if frames_per_block:
+        unlink_blocks(model, frames_per_block)
+    
+    n_spots = model.getSpots().getNSpots(False)
+    n_tracks = model.getTrackModel().nTracks(False)
+    log("  Found {} spots in {} 3D nuclei".format(n_spots, n_tracks))
+    
+    # Create label image
+    label_imp = LabelImgExporter.createLabelImagePlus(
+        trackmate,
+        False,
+        True,
+        LabelIdPainting.LABEL_IS_TRACK_ID
+    )
+    
+    if label_imp is None:
+        log("  WARNING: Label image creation failed")
+    return label_imp
+
+
+def tile_starts(size, tile):
+    """Evenly spaced start positions of tiles covering 0..size with at least
+    TILE_OVERLAP overlap"""
+    if size <= tile:
+        return [0]
+    n = -(-(size - TILE_OVERLAP) // (tile - TILE_OVERLAP))
+    return [int(round(i * (size - tile) / float(n - 1))) for i in range(n)]
+
+
+def strip_pixels(ips, x, y, strips):
+    """Pixels of the strips (x, y, width, height relative to (x, y)) of all
+    processors in ips, concatenated into a single-row ShortProcessor"""
+    crops = []
+    for ip in ips:
+        for sx, sy, sw, sh in strips:
+            ip.setRoi(x + sx, y + sy, sw, sh)
+            crops.append(ip.crop().getPixels())
+            ip.resetRoi()
+    size = sum(len(pixels) for pixels in crops)
+    joined = ShortProcessor(size, 1)
+    joined_pixels = joined.getPixels()
+    position = 0
+    for pixels in crops:
+        System.arraycopy(pixels, 0, joined_pixels, position, len(pixels))
+        position += len(pixels)
+    return joined
+
+
+def compact_labels(ip):
+    """Renumber the labels of a 16-bit processor to 1..n in place, returns the
+    original IDs (index 0 is background) and their pixel counts"""
+    histogram = ip.getHistogram()
+    lut = zeros(65536, 'i')
+    ids = [0]
+    areas = [0]
+    for label in range(1, int(ip.getStats().max) + 1):
+        if histogram[label]:
+            lut[label] = len(ids)
+            ids.append(label)
+            areas.append(histogram[label])
+    ip.applyTable(lut)
+    return ids, areas
+
+
+def stitch_tile(canvas_ips, tile_ips, x, y, overlap_x, overlap_y, next_id):
+    """Paste the labels of a tile (processors tile_ips) into the canvas frames
+    canvas_ips at (x, y). The left overlap_x columns and top overlap_y rows of
+    the tile are already covered by earlier tiles; tile labels matching a canvas
+    label there (IoU >= TILE_MIN_IOU) take over its ID, all other tile labels get
+    consecutive new IDs after next_id. Tile pixels are only pasted where the
+    canvas has no label yet. Returns the new next_id."""
+    w = tile_ips[0].getWidth()
+    h = tile_ips[0].getHeight()
+    # Track IDs of the tile renumbered to 1..n within these frames
+    tile_ips = renumber_labels(tile_ips)
+    n_tile_labels = max(int(ip.getStats().max) for ip in tile_ips)
+    
+    # Label pixels and intersections in the overlap, over all frames. Both sides
+    # are renumbered to 1..n, so every (canvas, tile) label pair gets its own
+    # value in a key image and the intersections are counted with one histogram.
+    best_match = {}
+    strips = [(0, 0, w, overlap_y), (0, overlap_y, overlap_x, h - overlap_y)]
+    strips = [strip for strip in strips if strip[2] > 0 and strip[3] > 0]
+    if strips:
+        canvas_overlap = strip_pixels(canvas_ips, x, y, strips)
+        tile_overlap = strip_pixels(tile_ips, 0, 0, strips)
+        canvas_ids, canvas_area = compact_labels(canvas_overlap)
+        tile_ids, tile_area = compact_labels(tile_overlap)
+        n_keys = len(canvas_ids) * len(tile_ids)
+        keys = canvas_overlap.convertToFloatProcessor()
+        keys.multiply(len(tile_ids))
+        keys.copyBits(tile_overlap.convertToFloatProcessor(), 0, 0, Blitter.ADD)
+        keys.setHistogramSize(n_keys)
+        keys.setHistogramRange(0, n_keys)
+        intersection = ImageStatistics.getStatistics(keys, Measurements.MIN_MAX, None).histogram
+        
+        for a in range(1, len(canvas_ids)):
+            for b in range(1, len(tile_ids)):
+                n = intersection[a * len(tile_ids) + b]
+                if not n:
+                    continue
+                iou = float(n) / (canvas_area[a] + tile_area[b] - n)
+                if iou >= TILE_MIN_IOU and iou > best_match.get(tile_ids[b], (0, 0.0))[1]:
+                    best_match[tile_ids[b]] = (canvas_ids[a], iou)
+    
+    # Relabel the tile and paste it where the canvas is still empty
+    lut = zeros(65536, 'i')
+    for b in range(1, n_tile_labels + 1):
+        if b in best_match:
+            lut[b] = best_match[b][0]
+        else:
+            next_id += 1
+            lut[b] = next_id
+    if next_id > 65535:
+        # Clamped IDs would merge unrelated nuclei
+        raise Exception("More than 65535 labels in one timepoint")
+    for ip, canvas_ip in zip(tile_ips, canvas_ips):
+        ip.applyTable(lut)
+        canvas_ip.setRoi(x, y, w, h)
+        ip.copyBits(canvas_ip.crop(), 0, 0, Blitter.COPY_ZERO_TRANSPARENT)
+        canvas_ip.resetRoi()
+        canvas_ip.copyBits(ip, x, y, Blitter.COPY)
+    return next_id
+
+
+def run_trackmate_tiled(imp_frames, frames_per_block=0):
+    """Run TrackMate on overlapping tiles of tile_size x tile_size pixels and
+    stitch the tile labels into one label image. Keeps the memory per StarDist
+    prediction bounded for very large XY planes. With frames_per_block, every
+    block of frames is stitched separately and gets its own label IDs."""
+    width = imp_frames.getWidth()
+    height = imp_frames.getHeight()
+    stack = imp_frames.getStack()
+    n = stack.getSize()
+    
+    canvas = ImageStack(width, height, n)
+    for z in range(1, n + 1):
+        canvas.setPixels(zeros(width * height, 'h'), z)
+    
+    block_size = frames_per_block or n
+    blocks = range(1, n + 1, block_size)
+    next_ids = [0] * len(blocks)
+    xs = tile_starts(width, tile_size)
+    ys = tile_starts(height, tile_size)
+    for iy, y in enumerate(ys):
+        for ix, x in enumerate(xs):
+            w = min(tile_size, width - x)
+            h = min(tile_size, height - y)
+            log("  Tile {} / {} at ({}, {})".format(iy * len(xs) + ix + 1, len(xs) * len(ys), x, y))
+            
+            tile_imp = ImagePlus("Tile", stack.crop(x, y, 0, w, h, n))
+            tile_imp.setCalibration(imp_frames.getCalibration())
+            tile_imp.setDimensions(1, 1, n)
+            tile_labels = run_trackmate(tile_imp, frames_per_block)
+            tile_imp.close()
+            if tile_labels is None:
+                continue
+            
+            overlap_x = xs[ix - 1] + tile_size - x if ix > 0 else 0
+            overlap_y = ys[iy - 1] + tile_size - y if iy > 0 else 0
+            tile_stack = tile_labels.getStack()
+            for i, start in enumerate(blocks):
+                frames = range(start, min(start + block_size, n + 1))
+                next_ids[i] = stitch_tile([canvas.getProcessor(z) for z in frames],
+                                          [tile_stack.getProcessor(z) for z in frames],
+                                          x, y, overlap_x, overlap_y, next_ids[i])
+            tile_labels.close()
+    
+    label_imp = ImagePlus("Labels", canvas)
+    label_imp.setCalibration(imp_frames.getCalibration())
+    label_imp.setDimensions(1, 1, n)
+    return label_imp
+
+
+def segment(imp_frames, frames_per_block=0):
+    """Segment z-slices stored as frames, tiled if the image exceeds the tile size"""
+    if tile_size > 0 and (imp_frames.getWidth() > tile_size or imp_frames.getHeight() > tile_size):
+        return run_trackmate_tiled(imp_frames, frames_per_block)
+    return run_trackmate(imp_frames, frames_per_block)
+
+
+class OutputFile(object):
+    """Per-file state shared by the functions that segment and write one file"""
+    def __init__(self, imp, writer, n_channels_out, pixel_type):
+        self.imp = imp
+        self.writer = writer
+        self.n_channels_out = n_channels_out
+        self.pixel_type = pixel_type
+        # Single zero-filled plane reused for all failed timepoints
+        self.empty_plane = plane_bytes(ShortProcessor(imp.getWidth(), imp.getHeight()), pixel_type)
+        # Timepoints without labels, with the reason
+        self.missing_timepoints = {}
+        # Index of the next plane to write; planes are written sequentially
+        self.next_plane = 0
+
+
+def write_plane(output, plane_index, plane):
+    """Write one plane and remember where the file continues"""
+    output.writer.saveBytes(plane_index, plane)
+    output.next_plane = plane_index + 1
+
+
+def write_timepoint(output, t, label_planes):
+    """Write the planes of timepoint t in XYCZT order: the original
+    channels (when appending) followed by the label channel"""
+    imp = output.imp
+    n_channels_out = output.n_channels_out
+    for z in range(1, imp.getNSlices() + 1):
+        plane_index = ((t - 1) * imp.getNSlices() + (z - 1)) * n_channels_out
+        if append_to_original:
+            for c in range(1, imp.getNChannels() + 1):
+                with plane_lock:
+                    ip = imp.getStack().getProcessor(imp.getStackIndex(c, z, t))
+                write_plane(output, plane_index + c - 1, plane_bytes(ip, output.pixel_type))
+        write_plane(output, plane_index + n_channels_out - 1, label_planes[z - 1])
+
+
+def pad_timepoint(output, t):
+    """Fill the planes of timepoint t that were not written with the empty
+    plane, a sequentially written file must not have gaps"""
+    for plane_index in range(output.next_plane, t * output.imp.getNSlices() * output.n_channels_out):
+        write_plane(output, plane_index, output.empty_plane)
+
+
+def write_missing(output, t, status):
+    """Write timepoint t with the shared empty plane as labels"""
+    output.missing_timepoints[t] = status
+    write_timepoint(output, t, [output.empty_plane] * output.imp.getNSlices())
+
+
+def release_original(imp):
+    """Free the original image once the target channel has been read,
+    unless its channels are written to the output as well"""
+    if not append_to_original:
+        imp.flush()
+
+
+def segment_batched(imp):
+    """Segment all timepoints in a single TrackMate run, returns the label
+    image with a separator frame after every timepoint, or None"""
+    width = imp.getWidth()
+    height = imp.getHeight()
+    n_slices = imp.getNSlices()
+    n_frames = imp.getNFrames()
+    # Target channel of all timepoints as one stack of z-slices as frames. The
+    # stack references the pixels of imp (or reads them once from a virtual
+    # stack). An empty frame is inserted after every timepoint, and links
+    # between timepoints are removed after tracking.
+    stack = imp.getStack()
+    separator = stack.getProcessor(1).createProcessor(width, height).getPixels()
+    batch_stack = ImageStack(width, height, n_frames * (n_slices + 1))
+    for t in range(1, n_frames + 1):
+        offset = (t - 1) * (n_slices + 1)
+        for z in range(1, n_slices + 1):
+            batch_stack.setPixels(stack.getPixels(imp.getStackIndex(target_channel, z, t)), offset + z)
+            batch_stack.setSliceLabel("t{}_z{}".format(t, z), offset + z)
+        batch_stack.setPixels(separator, offset + n_slices + 1)
+        batch_stack.setSliceLabel("t{}_separator".format(t), offset + n_slices + 1)
+    imp_all = ImagePlus("All timepoints", batch_stack)
+    imp_all.setCalibration(imp.getCalibration())
+    imp_all.setDimensions(1, 1, batch_stack.getSize())
+    
+    log("\nProcessing all {} timepoints in one TrackMate run...".format(n_frames))
+    flush_log()
+    try:
+        label_imp = segment(imp_all, n_slices + 1)
+    finally:
+        imp_all.close()
+        flush_log()
+    # Keep the original until segmentation succeeded, the timepoints are
+    # segmented one by one from it otherwise
+    if label_imp is not None:
+        release_original(imp)
+    return label_imp
+
+
+def write_batched(output, label_imp):
+    """Write the labels of segment_batched(), skipping the separators. The
+    track IDs are unique within the file and renumbered per timepoint."""
+    n_slices = output.imp.getNSlices()
+    label_stack = label_imp.getStack()
+    for t in range(1, output.imp.getNFrames() + 1):
+        offset = (t - 1) * (n_slices + 1)
+        label_ips = renumber_labels([label_stack.getProcessor(offset + z)
+                                     for z in range(1, n_slices + 1)])
+        write_timepoint(output, t, [plane_bytes(ip, output.pixel_type) for ip in label_ips])
+    label_imp.close()
+
+
+def run_pipeline(output):
+    """Segment the timepoints one by one"""
+    imp = output.imp
+    width = imp.getWidth()
+    height = imp.getHeight()
+    n_slices = imp.getNSlices()
+    n_frames = imp.getNFrames()
+    # Process the timepoints as a pipeline: a reader thread extracts the next
+    # timepoints while TrackMate/StarDist runs on the current one, and a writer
+    # thread saves finished labels to the output file
+    timepoint_queue = ArrayBlockingQueue(2)
+    label_queue = ArrayBlockingQueue(2)
+    # Errors that leave the output file incomplete
+    write_errors = []
+    
+    def read_timepoints():
+        try:
+            stack = imp.getStack()
+            for t in range(1, n_frames + 1):
+                try:
+                    # Single timepoint with all z-slices. The stack references the
+                    # pixels of imp instead of copying them, TrackMate only reads them.
+                    stack_t = ImageStack(width, height, n_slices)
+                    with plane_lock:
+                        for z in range(1, n_slices + 1):
+                            stack_t.setPixels(stack.getPixels(imp.getStackIndex(target_channel, z, t)), z)
+                    imp_t = ImagePlus("Timepoint {}".format(t), stack_t)
+                    imp_t.setCalibration(imp.getCalibration())
+                    # Convert Z-slices to frames for TrackMate
+                    imp_t.setDimensions(1, 1, n_slices)
+                except Exception as e:
+                    log("  ERROR: Could not extract timepoint {}: {}".format(t, str(e)))
+                    imp_t = None
+                timepoint_queue.put((t, imp_t))
+            release_original(imp)
+        finally:
+            timepoint_queue.put(END_OF_STREAM)
+    
+    def write_labels():
+        item = None
+        try:
+            while True:
+                item = label_queue.take()
+                if item is END_OF_STREAM:
+                    break
+                t, label_imp_t, status = item
+                if write_errors:
+                    # The output file is already broken, only drain the queue
+                    if label_imp_t is not None:
+                        label_imp_t.close()
+                    continue
+                try:
+                    if label_imp_t is None:
+                        write_missing(output, t, status)
+                        continue
+                    
+                    # Frame z of the label stack is z-slice z; the stack processors
+                    # wrap the label pixels without copying them
+                    label_stack = label_imp_t.getStack()
+                    label_planes = [plane_bytes(label_stack.getProcessor(z), output.pixel_type)
+                                    for z in range(1, n_slices + 1)]
+                    write_timepoint(output, t, label_planes)
+                    label_imp_t.close()
+                except Exception as e:
+                    log("  ERROR: Could not write labels of timepoint {}: {}".format(t, str(e)))
+                    output.missing_timepoints[t] = "error"
+                    try:
+                        pad_timepoint(output, t)
+                    except Exception as e:
+                        write_errors.append(e)
+                flush_log()
+        except Exception as e:
+            write_errors.append(e)
+        finally:
+            # Keep taking labels until the end of the stream, the main thread
+            # blocks on the full queue otherwise
+            while item is not END_OF_STREAM:
+                item = label_queue.take()
+                if item is not END_OF_STREAM and item[1] is not None:
+                    item[1].close()
+    
+    reader = Thread(PipelineStage(read_timepoints))
+    label_writer = Thread(PipelineStage(write_labels))
+    reader.start()
+    label_writer.start()
+    
+    # Segment each timepoint as it becomes available
+    item = None
+    try:
+        while True:
+            item = timepoint_queue.take()
+            if item is END_OF_STREAM:
+                break
+            t, imp_t = item
+            if imp_t is None:
+                label_queue.put((t, None, "error"))
+                continue
+            
+            log("\nProcessing timepoint {} / {}...".format(t, n_frames))
+            try:
+                label_imp_t = segment(imp_t)
+                label_queue.put((t, label_imp_t, "empty"))
+            except Exception as e:
+                log("  ERROR: {}".format(str(e)))
+                label_queue.put((t, None, "error"))
+            finally:
+                imp_t.close()
+    finally:
+        label_queue.put(END_OF_STREAM)
+        # Take the remaining timepoints if the loop ended early, the reader
+        # blocks on the full queue otherwise
+        while item is not END_OF_STREAM:
+            item = timepoint_queue.take()
+            if item is not END_OF_STREAM and item[1] is not None:
+                item[1].close()
+        reader.join()
+        label_writer.join()
+    if write_errors:
+        raise write_errors[0]
+
+
+# Tiles must be larger than their overlap with both neighbours
+if 0 < tile_size <= 2 * TILE_OVERLAP:
+    log("WARNING: Tile size must be larger than {}, tiling disabled".format(2 * TILE_OVERLAP))
+    tile_size = 0
+
+# StarDist detector, created once and reused for all timepoints of all files
+detector_factory = StarDistDetectorFactory()
+detector_settings = {
+    'TARGET_CHANNEL': 1,
+    'SCORE_THRESHOLD': prob_threshold,
+    'OVERLAP_THRESHOLD': overlap_threshold
+}
+
+# Overlap tracker
+tracker_factory = OverlapTrackerFactory()
+tracker_settings = {
+    'IOU_CALCULATION': 'PRECISE',
+    'MIN_IOU': min_iou,
+    'SCALE_FACTOR': 1.0
+}
+
+log("=" * 60)
+log("3D NUCLEI SEGMENTATION WITH STARDIST")
+log("=" * 60)
+log("Number of files to process: {}".format(len(input_files)))
+log("Append to original: {}".format(append_to_original))
+log("Single TrackMate run per file: {}".format(single_run))
+log("=" * 60)
+flush_log()
+
+# Output location and naming are the same for all files (output is always .tif)
+output_path = output_dir.getAbsolutePath()
+if not os.path.isdir(output_path):
+    os.makedirs(output_path)
+output_suffix = "_with_labels.tif" if append_to_original else "_label_3D.tif"
 
 # Process each file
 for file_idx, input_file in enumerate(input_files):
-    print("\n" + "=" * 60)
-    print("FILE {} / {}: {}".format(file_idx + 1, len(input_files), input_file.getName()))
-    print("=" * 60)
+    original_name = input_file.getName()
+    # Remove extension regardless of input format
+    out_path = os.path.join(output_path, os.path.splitext(original_name)[0] + output_suffix)
+    
+    log("\n" + "=" * 60)
+    log("FILE {} / {}: {}".format(file_idx + 1, len(input_files), original_name))
+    log("=" * 60)
     
     try:
         # Open the image (handles nd2, tif, etc.)
-        print("Opening image...")
-        imp = IJ.openImage(input_file.getAbsolutePath())
+        log("Opening image...")
+        imp = open_image(input_file.getAbsolutePath())
         if imp is None:
-            print("ERROR: Could not open file")
+            log("ERROR: Could not open file")
             continue
         
         # Get image dimensions
@@ -55,213 +721,84 @@ for file_idx, input_file in enumerate(input_files):
         n_slices = imp.getNSlices()
         n_frames = imp.getNFrames()
         
-        print("Image dimensions: {} x {}".format(width, height))
-        print("Channels: {}, Z-slices: {}, Timepoints: {}".format(n_channels, n_slices, n_frames))
+        log("Image dimensions: {} x {}".format(width, height))
+        log("Channels: {}, Z-slices: {}, Timepoints: {}".format(n_channels, n_slices, n_frames))
         
         # Validate inputs
         if target_channel < 1 or target_channel > n_channels:
-            print("ERROR: Channel {} is out of range (image has {} channels)".format(
+            log("ERROR: Channel {} is out of range (image has {} channels)".format(
                 target_channel, n_channels))
             imp.close()
             continue
         
         if n_slices < 2:
-            print("WARNING: Image has only {} z-slice(s)".format(n_slices))
-        
-        # Create output stack for labels
-        output_stack = ImageStack(width, height)
-        successful_timepoints = 0
-        
-        # Process each timepoint
-        for t in range(1, n_frames + 1):
-            print("\nProcessing timepoint {} / {}...".format(t, n_frames))
-            
-            try:
-                # Extract single timepoint with all z-slices
-                imp_t = Duplicator().run(imp, target_channel, target_channel, 1, n_slices, t, t)
-                
-                # Convert Z-slices to frames for TrackMate
-                imp_t.setDimensions(1, 1, n_slices)
-                
-                # Set up TrackMate
-                model = Model()
-                model.setLogger(Logger.IJ_LOGGER)
-                
-                settings = Settings(imp_t)
-                
-                # StarDist detector
-                settings.detectorFactory = StarDistDetectorFactory()
-                settings.detectorSettings = {
-                    'TARGET_CHANNEL': 1,
-                    'SCORE_THRESHOLD': prob_threshold,
-                    'OVERLAP_THRESHOLD': overlap_threshold
-                }
-                
-                # Overlap tracker
-                settings.trackerFactory = OverlapTrackerFactory()
-                settings.trackerSettings = {
-                    'IOU_CALCULATION': 'PRECISE',
-                    'MIN_IOU': min_iou,
-                    'SCALE_FACTOR': 1.0
-                }
-                
-                settings.addAllAnalyzers()
-                
-                # Run TrackMate
-                trackmate = TrackMate(model, settings)
-                
-                if not trackmate.checkInput():
-                    print("  ERROR: {}".format(trackmate.getErrorMessage()))
-                    imp_t.close()
-                    # Add empty slices
-                    for z in range(n_slices):
-                        empty_ip = IJ.createImage("Empty", width, height, 1, 16).getProcessor()
-                        output_stack.addSlice("t{}_z{}_empty".format(t, z+1), empty_ip)
-                    continue
-                
-                if not trackmate.process():
-                    print("  ERROR: {}".format(trackmate.getErrorMessage()))
-                    imp_t.close()
-                    # Add empty slices
-                    for z in range(n_slices):
-                        empty_ip = IJ.createImage("Empty", width, height, 1, 16).getProcessor()
-                        output_stack.addSlice("t{}_z{}_empty".format(t, z+1), empty_ip)
-                    continue
-                
-                n_spots = model.getSpots().getNSpots(False)
-                n_tracks = model.getTrackModel().nTracks(False)
-                print("  Found {} spots in {} 3D nuclei".format(n_spots, n_tracks))
-                
-                # Create label image
-                label_imp_t = LabelImgExporter.createLabelImagePlus(
-                    trackmate,
-                    False,
-                    True,
-                    LabelIdPainting.LABEL_IS_TRACK_ID
-                )
-                
-                if label_imp_t is None:
-                    print("  WARNING: Label image creation failed")
-                    imp_t.close()
-                    # Add empty slices
-                    for z in range(n_slices):
-                        empty_ip = IJ.createImage("Empty", width, height, 1, 16).getProcessor()
-                        output_stack.addSlice("t{}_z{}_empty".format(t, z+1), empty_ip)
-                    continue
-                
-                # Convert frames back to z-slices
-                n_label_frames = label_imp_t.getNFrames()
-                label_imp_t.setDimensions(1, n_label_frames, 1)
-                
-                # Add to output stack
-                for z in range(1, label_imp_t.getNSlices() + 1):
-                    label_imp_t.setSlice(z)
-                    ip = label_imp_t.getProcessor().duplicate()
-                    output_stack.addSlice("t{}_z{}".format(t, z), ip)
-                
-                successful_timepoints += 1
-                
-                # Clean up
-                label_imp_t.close()
-                imp_t.close()
-                
-            except Exception as e:
-                print("  ERROR: {}".format(str(e)))
-                # Add empty slices
-                for z in range(n_slices):
-                    empty_ip = IJ.createImage("Empty", width, height, 1, 16).getProcessor()
-                    output_stack.addSlice("t{}_z{}_error".format(t, z+1), empty_ip)
-        
-        print("\nSuccessfully processed {} / {} timepoints".format(successful_timepoints, n_frames))
-        
-        if output_stack.getSize() == 0:
-            print("ERROR: No labels created")
-            imp.close()
-            continue
-        
-        # Create label hyperstack
-        print("Creating label hyperstack...")
-        label_imp = ImagePlus("Labels", output_stack)
-        label_imp = HyperStackConverter.toHyperStack(
-            label_imp, 
-            1,
-            n_slices,
-            n_frames,
-            "default",
-            "Grayscale"
-        )
-        
-        # Set calibration
-        cal = imp.getCalibration()
-        label_imp.setCalibration(cal)
-        
-        # Prepare output filename (always .tif)
-        original_name = input_file.getName()
-        # Remove extension regardless of input format
-        name_without_ext = os.path.splitext(original_name)[0]
+            log("WARNING: Image has only {} z-slice(s)".format(n_slices))
         
         if append_to_original:
-            print("Appending labels to original image...")
+            # All original channels + 1 label channel; channels share one pixel type
+            log("Appending labels to original image ({} channel(s) + 1 label channel)".format(n_channels))
+            n_channels_out = n_channels + 1
+            pixel_type = "float" if imp.getBitDepth() == 32 else "uint16"
+        else:
+            n_channels_out = 1
+            pixel_type = "uint16"
+        
+        # Labels are streamed to disk per timepoint instead of collected in memory
+        writer = open_writer(out_path, imp, n_channels_out, pixel_type)
+        output = OutputFile(imp, writer, n_channels_out, pixel_type)
+        try:
+            # One TrackMate run for the whole file only saves setting up TrackMate for
+            # every timepoint. StarDist still predicts frame by frame, and the 32-bit
+            # label image of all timepoints must fit in memory, so it is optional.
+            batch_bytes = 4 * width * height * n_frames * (n_slices + 1)
+            if imp.getStack().isVirtual():
+                # The target channel is read into memory as well
+                batch_bytes += imp.getBytesPerPixel() * width * height * n_frames * n_slices
+            batch_mode = single_run and n_frames > 1 and fits_in_memory(batch_bytes)
+            if batch_mode:
+                try:
+                    label_imp = segment_batched(imp)
+                except Exception as e:
+                    log("  ERROR: {}".format(str(e)))
+                    label_imp = None
+                if label_imp is None:
+                    log("Segmenting all timepoints at once failed, processing them one by one")
+                    batch_mode = False
+            elif single_run and n_frames > 1:
+                log("Not enough memory to segment all timepoints at once, processing them one by one")
             
-            # Check if original is already multi-channel
-            if n_channels == 1:
-                # Original is single channel, merge with labels
-                merged_imp = RGBStackMerge.mergeChannels([imp, label_imp], False)
-                merged_imp.setTitle(name_without_ext + "_with_labels")
-                
-                # Set calibration
-                merged_imp.setCalibration(cal)
-                
-                # Save merged image as TIFF
-                output_file = File(output_dir, name_without_ext + "_with_labels.tif")
-                IJ.save(merged_imp, output_file.getAbsolutePath())
-                print("Saved merged image: {}".format(output_file.getName()))
-                
-                merged_imp.close()
+            if batch_mode:
+                write_batched(output, label_imp)
             else:
-                # Original has multiple channels, need to add label as new channel
-                print("  Creating stack with {} original channels + 1 label channel...".format(n_channels))
-                
-                # Create list of channels: all original channels + label channel
-                channels = []
-                for c in range(1, n_channels + 1):
-                    ch_imp = Duplicator().run(imp, c, c, 1, n_slices, 1, n_frames)
-                    channels.append(ch_imp)
-                channels.append(label_imp)
-                
-                # Merge all channels
-                merged_imp = RGBStackMerge.mergeChannels(channels, False)
-                merged_imp.setTitle(name_without_ext + "_with_labels")
-                
-                # Set calibration
-                merged_imp.setCalibration(cal)
-                
-                # Save merged image as TIFF
-                output_file = File(output_dir, name_without_ext + "_with_labels.tif")
-                IJ.save(merged_imp, output_file.getAbsolutePath())
-                print("Saved merged image: {}".format(output_file.getName()))
-                
-                # Close channel images
-                for ch_imp in channels[:-1]:  # Don't close label_imp, we'll close it below
-                    ch_imp.close()
-                merged_imp.close()
-        else:
-            # Save labels as separate TIFF file
-            output_file = File(output_dir, name_without_ext + "_label_3D.tif")
-            IJ.save(label_imp, output_file.getAbsolutePath())
-            print("Saved label image: {}".format(output_file.getName()))
+                run_pipeline(output)
+        finally:
+            writer.close()
+        
+        missing_timepoints = output.missing_timepoints
+        successful_timepoints = n_frames - len(missing_timepoints)
+        log("\nSuccessfully processed {} / {} timepoints".format(successful_timepoints, n_frames))
+        if missing_timepoints:
+            log("Timepoints saved without labels: {}".format(", ".join(
+                "{} ({})".format(t, missing_timepoints[t]) for t in sorted(missing_timepoints))))
+        log("Saved {}: {}".format("merged image" if append_to_original else "label image",
+                                  os.path.basename(out_path)))
         
         # Clean up
-        label_imp.close()
         imp.close()
         
-        print("Completed processing: {}".format(original_name))
+        log("Completed processing: {}".format(original_name))
         
     except Exception as e:
-        print("ERROR processing file: {}".format(str(e)))
+        log("ERROR processing file: {}".format(str(e)))
+        flush_log()
         import traceback
         traceback.print_exc()
+    finally:
+        flush_log()
+        # Collect the garbage of this file now rather than during the next segmentation
+        System.gc()
 
-print("\n" + "=" * 60)
-print("ALL FILES PROCESSED")
-print("=" * 60)
+log("\n" + "=" * 60)
+log("ALL FILES PROCESSED")
+log("=" * 60)
+flush_log()
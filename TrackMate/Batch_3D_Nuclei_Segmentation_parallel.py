@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Parallel batch launcher for 3D_Nuclei_Segmentation_StarDist_TrackMate.py
+
+Files are independent of each other, so instead of looping over them in a single
+Jython interpreter this launcher starts one headless Fiji process per file and
+keeps a pool of them running at the same time. Each Fiji process gets its own JVM
+and its own StarDist model instance, which avoids sharing one interpreter between
+files.
+
+Run with regular Python 3 (not from within Fiji):
+
+    python3 Batch_3D_Nuclei_Segmentation_parallel.py \\
+        --fiji ~/Fiji.app/ImageJ-linux64 --workers 4 \\
+        --output /data/labels /data/raw/*.nd2
+
+The output of every Fiji process is written to <output>/<file name>.log.
+
+Each JVM uses the G1 garbage collector with a pause target, which keeps long
+batches from stalling on full collections. The heap is fixed at --heap
+(-Xms = -Xmx) and pre-touched at startup, so it is not grown and paged in
+during segmentation. Without --heap, 75% of the physical memory is divided
+over the workers; Fiji's own default would give every worker most of the RAM.
+
+Note: every worker loads its own StarDist model. When StarDist runs on a GPU
+(CUDA), limit --workers to the number of models that fit in GPU memory.
+
+Developed by Maarten Paul (m.w.paul@lacdr.leidenuniv.nl) @maartenpaul at Github
+
+Version 2026-10-15: Initial version of the launcher
+"""
+
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "3D_Nuclei_Segmentation_StarDist_TrackMate.py")
+
+GC_OPTIONS = ["-XX:+UseG1GC", "-XX:MaxGCPauseMillis=200"]
+
+# Part of the physical memory shared by the worker heaps when --heap is not given
+HEAP_FRACTION = 0.75
+
+# Fiji exits with 0 even when the script fails, these lines in its output mark a failed file
+ERROR_MARKERS = ("ERROR processing file", "ERROR: Could not open file", "ERROR: Channel")
+
+# Characters that cannot be used in the quoted paths of the --run parameter string
+UNSUPPORTED_PATH_CHARACTERS = ("'", ",")
+
+
+def default_heap(workers):
+    """Heap size per worker from the physical memory, or None if it is unknown."""
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+    return "{}m".format(int(memory * HEAP_FRACTION / workers) // (1024 * 1024))
+
+
+def jvm_options(args):
+    """Java options passed to Fiji before the '--' separator."""
+    options = list(GC_OPTIONS)
+    if args.heap:
+        options += ["-Xms" + args.heap, "-Xmx" + args.heap, "-XX:+AlwaysPreTouch"]
+    return options
+
+
+def script_arguments(input_file, args):
+    """Build the SciJava parameter string for a single input file."""
+    # A single path is converted to the File[] parameter of the script
+    params = [
+        "input_files='{}'".format(input_file),
+        "target_channel={}".format(args.channel),
+        "prob_threshold={}".format(args.prob_threshold),
+        "overlap_threshold={}".format(args.overlap_threshold),
+        "min_iou={}".format(args.min_iou),
+        "append_to_original={}".format("true" if args.append_to_original else "false"),
+        "tile_size={}".format(args.tile_size),
+        "single_run={}".format("true" if args.single_run else "false"),
+        "output_dir='{}'".format(args.output),
+    ]
+    return ",".join(params)
+
+
+def output_file(input_file, args):
+    """Path of the output file the script writes for input_file."""
+    suffix = "_with_labels.tif" if args.append_to_original else "_label_3D.tif"
+    return os.path.join(args.output, os.path.splitext(os.path.basename(input_file))[0] + suffix)
+
+
+def succeeded(input_file, args, log_path, started):
+    """Check that the script wrote its output in this run and logged no file error."""
+    out_path = output_file(input_file, args)
+    if not os.path.exists(out_path) or os.path.getmtime(out_path) < started:
+        return False
+    with open(log_path) as log:
+        return not any(marker in line for line in log for marker in ERROR_MARKERS)
+
+
+def process_file(job):
+    """Segment one file in a headless Fiji process, returns (file, status, log)."""
+    input_file, args = job
+    log_path = os.path.join(args.output, os.path.basename(input_file) + ".log")
+    command = [args.fiji] + jvm_options(args) + [
+        "--", "--headless", "--console",
+        "--run", SCRIPT, script_arguments(input_file, args),
+    ]
+    started = time.time()
+    with open(log_path, "w") as log:
+        result = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+        status = "exit code {}".format(result.returncode)
+    elif not succeeded(input_file, args, log_path, started):
+        status = "no output written"
+    else:
+        status = None
+    return input_file, status, log_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the StarDist/TrackMate 3D nuclei segmentation on "
+                    "multiple files in parallel headless Fiji processes.")
+    parser.add_argument("input_files", nargs="+", help="Images to segment (nd2, tif, ...)")
+    parser.add_argument("--fiji", required=True, help="Path to the Fiji executable (e.g. ImageJ-linux64)")
+    parser.add_argument("--output", required=True, help="Output directory")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="Number of files processed at the same time (default: 2)")
+    parser.add_argument("--heap", default=None,
+                        help="Fixed Java heap size per worker, e.g. 16g "
+                             "(default: 75%% of the physical memory divided over the workers)")
+    parser.add_argument("--channel", type=int, default=1, help="Channel to segment (default: 1)")
+    parser.add_argument("--prob-threshold", type=float, default=0.5)
+    parser.add_argument("--overlap-threshold", type=float, default=0.3)
+    parser.add_argument("--min-iou", type=float, default=0.1)
+    parser.add_argument("--tile-size", type=int, default=0,
+                        help="Segment large images in tiles of this size (default: 0, no tiling)")
+    parser.add_argument("--single-run", action="store_true",
+                        help="Segment all timepoints of a file in one TrackMate run when memory allows")
+    parser.add_argument("--labels-only", dest="append_to_original", action="store_false",
+                        help="Save labels as separate file instead of appending to the original")
+    args = parser.parse_args()
+    if args.heap is None:
+        args.heap = default_heap(args.workers)
+        if args.heap is None and args.workers > 1:
+            parser.error("--heap is required with more than one worker, "
+                         "the physical memory of this system is unknown")
+
+    args.output = os.path.abspath(args.output)
+    for path in [args.output] + args.input_files:
+        if any(c in os.path.abspath(path) for c in UNSUPPORTED_PATH_CHARACTERS):
+            parser.error("path contains one of {}: {}".format(
+                " ".join(UNSUPPORTED_PATH_CHARACTERS), path))
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    jobs = [(os.path.abspath(f), args) for f in args.input_files]
+    print("Processing {} files with {} workers ({} heap each)".format(
+        len(jobs), args.workers, args.heap or "default"))
+
+    failed = 0
+    pool = multiprocessing.Pool(processes=args.workers)
+    try:
+        for input_file, status, log_path in pool.imap_unordered(process_file, jobs):
+            if status is None:
+                print("Done:   {}".format(input_file))
+            else:
+                failed += 1
+                print("FAILED: {} ({}, see {})".format(input_file, status, log_path))
+    finally:
+        pool.close()
+        pool.join()
+
+    print("{} / {} files completed".format(len(jobs) - failed, len(jobs)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())